@@ -8,12 +8,16 @@ that uses Demucs (htdemucs_6s) to split a track into 5 stems:
 Run:  pip install -r requirements.txt && python app.py
 """
 
+import hashlib
+import multiprocessing as mp
 import os
-import uuid
 import shutil
 import subprocess
-import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy as np
 from flask import Flask, request, jsonify, send_from_directory
 
 try:
@@ -22,6 +26,20 @@ except ImportError:
     MonoLoader = None
     RhythmExtractor2013 = None
 
+try:
+    import torch
+    from demucs.api import Separator, save_audio
+except ImportError:
+    torch = None
+    Separator = None
+    save_audio = None
+
+try:
+    from scipy.signal import butter, sosfiltfilt
+except ImportError:
+    butter = None
+    sosfiltfilt = None
+
 # ── Paths ──────────────────────────────────────────────────────
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), 'output')
@@ -29,6 +47,167 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 app = Flask(__name__, static_folder=PROJECT_ROOT, static_url_path='')
 
+# Reject oversized uploads at the protocol layer, before any bytes are
+# spooled to disk or reach the separation pipeline.
+app.config['MAX_CONTENT_LENGTH'] = 200 * 1024 * 1024
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': 'File too large'}), 413
+
+# ── Demucs worker pool ────────────────────────────────────────
+# Each worker loads htdemucs_6s once in its initializer and keeps it
+# resident, so concurrent /api/separate requests scale with the worker
+# count instead of serializing behind a single in-process model, and
+# inference never contends with Flask's request threads for the GIL.
+DEMUCS_WORKERS = int(os.environ.get('DEMUCS_WORKERS', '1'))
+
+_separator = None  # populated per worker process by _load_model
+
+_demucs_pool = None
+_demucs_pool_lock = threading.Lock()
+
+
+def _load_model():
+    global _separator
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    _separator = Separator(model='htdemucs_6s', device=device)
+
+
+def _get_demucs_pool():
+    global _demucs_pool
+    with _demucs_pool_lock:
+        if _demucs_pool is None:
+            # fork avoids re-importing PyTorch per worker on Linux/mac.
+            method = 'fork' if 'fork' in mp.get_all_start_methods() else None
+            _demucs_pool = ProcessPoolExecutor(
+                max_workers=DEMUCS_WORKERS,
+                initializer=_load_model,
+                mp_context=mp.get_context(method),
+            )
+    return _demucs_pool
+
+
+def _warm_pool():
+    """Spin up the Demucs workers ahead of the first request.
+
+    Worker start-up loads the model weights, so warming at boot
+    overlaps that multi-second load with the first upload instead of
+    adding it to the first request's latency. Fire-and-forget: the
+    no-op submits just force the executor to start its workers.
+    """
+    if Separator is None:
+        return
+    pool = _get_demucs_pool()
+    for _ in range(DEMUCS_WORKERS):
+        pool.submit(os.getpid)
+
+
+def _run_job(job_dir, tmp_path):
+    """Worker-side: separate a track and write its stem WAVs.
+
+    Runs in a pool worker where _load_model stashed the resident
+    Separator. Tensors never cross the process boundary — only the
+    stem directory path does.
+    """
+    if torch.cuda.is_available():
+        # FP16 halves activation bandwidth and uses tensor cores;
+        # inference_mode skips autograd bookkeeping.
+        with torch.inference_mode(), \
+                torch.autocast(device_type='cuda', dtype=torch.float16):
+            _, stems = _separator.separate_audio_file(tmp_path)
+    else:
+        _, stems = _separator.separate_audio_file(tmp_path)
+
+    # Merge guitar + piano + other → single "other". Stems share
+    # length, rate and channel count, so the merge is one elementwise
+    # sum, scaled by the input count to match amix's normalization.
+    merge = [
+        stems.pop(name)
+        for name in ('guitar', 'piano', 'other')
+        if name in stems
+    ]
+    if merge:
+        stems['other'] = sum(merge) / len(merge)
+
+    # Kick isolation: 4th-order Butterworth low-pass at 150Hz on the
+    # drums tensor. The complementary high-pass is just a subtraction,
+    # so the whole split costs a few ms of vectorized DSP instead of
+    # an ffmpeg decode + filter pass.
+    drums = stems.pop('drums').cpu()
+    sos = butter(4, 150, btype='low', fs=_separator.samplerate, output='sos')
+    kick_arr = sosfiltfilt(sos, drums.numpy(), axis=-1)
+    kick = torch.from_numpy(np.ascontiguousarray(kick_arr)).to(drums.dtype)
+    stems['kick'] = kick
+    stems['drums'] = drums - kick
+
+    # Write the 5 final stems as WAV; the request handler MP3-encodes
+    # them.
+    stem_dir = os.path.join(job_dir, 'stems')
+    os.makedirs(stem_dir, exist_ok=True)
+    for name, tensor in stems.items():
+        save_audio(
+            tensor,
+            os.path.join(stem_dir, f'{name}.wav'),
+            samplerate=_separator.samplerate,
+        )
+    return stem_dir
+
+
+# ── Output retention ──────────────────────────────────────────
+# Completed jobs double as the content-addressed cache, so they are
+# kept around — but trimmed oldest-first to a disk budget so the
+# server can't fill up.
+OUTPUT_BUDGET_BYTES = int(
+    os.environ.get('OUTPUT_BUDGET_BYTES', str(10 * 1024 ** 3))
+)
+EVICT_INTERVAL_SEC = 15 * 60
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _evict_old_jobs():
+    """Trim OUTPUT_DIR to the disk budget, least recently used first.
+
+    scandir yields each entry's stat without a separate syscall per
+    job, and cache hits bump the job dir's mtime so hot entries
+    survive eviction.
+    """
+    try:
+        entries = [e for e in os.scandir(OUTPUT_DIR) if e.is_dir()]
+        # stat inside the try: an entry removed concurrently would
+        # otherwise raise here and kill the eviction thread for good.
+        jobs = sorted(
+            (e.stat().st_mtime, e.path, _dir_size(e.path)) for e in entries
+        )
+    except OSError:
+        return
+    total = sum(size for _, _, size in jobs)
+    for _, path, size in jobs:
+        if total <= OUTPUT_BUDGET_BYTES:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def _start_eviction_thread():
+    def loop():
+        while True:
+            _evict_old_jobs()
+            time.sleep(EVICT_INTERVAL_SEC)
+
+    threading.Thread(target=loop, daemon=True).start()
+
 
 # ── Static file serving ───────────────────────────────────────
 @app.route('/')
@@ -41,7 +220,58 @@ def static_files(path):
     return send_from_directory(PROJECT_ROOT, path)
 
 
+@app.route('/server/output/<job_id>/<path:filename>')
+def stem_file(job_id, filename):
+    # Job dirs are content-addressed, so a stem URL never changes its
+    # bytes: browsers may cache forever, and conditional requests get
+    # 304s via the ETag from send_from_directory.
+    resp = send_from_directory(
+        OUTPUT_DIR, os.path.join(job_id, filename),
+        conditional=True, max_age=31536000,
+    )
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+
 # ── Stem separation endpoint ──────────────────────────────────
+STEM_NAMES = ('kick', 'drums', 'bass', 'vocals', 'other')
+
+
+def _stem_urls(job_id):
+    base = f'/server/output/{job_id}'
+    return {name: f'{base}/{name}.mp3' for name in STEM_NAMES}
+
+
+def _encode_one(cmd):
+    # text=True so a CalledProcessError carries str stderr, which the
+    # error handler passes to jsonify (bytes would fail to serialize).
+    subprocess.run(cmd, check=True, capture_output=True, text=True)
+
+
+def _run_encodes(jobs):
+    """Run a batch of ffmpeg encode commands in parallel.
+
+    LAME is single-threaded but the encodes are independent. Each job
+    is its own ffmpeg process and subprocess.run releases the GIL
+    while waiting, so threads are enough for full cross-core
+    parallelism — no fork from the threaded server, no per-request
+    process pool.
+    """
+    if not jobs:
+        return
+    workers = min(len(jobs), max(1, (os.cpu_count() or 2) - 1))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(_encode_one, jobs))
+
+
+# In-flight separations keyed by job id: job dirs are shared between
+# requests now that they are content-addressed, so a re-upload that
+# arrives while the same file is still separating must wait on the
+# first request instead of racing its pipeline and cleanup.
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
 @app.route('/api/separate', methods=['POST'])
 def separate():
     if 'file' not in request.files:
@@ -51,131 +281,137 @@ def separate():
     if not file.filename:
         return jsonify({'error': 'Empty filename'}), 400
 
-    job_id = str(uuid.uuid4())
+    # Stream the upload to disk in fixed 1MiB chunks, hashing as we
+    # go: peak memory stays constant instead of O(file size), and the
+    # digest doubles as the content-addressed job id so re-uploads of
+    # the same file return the cached stems instead of re-running the
+    # model.
+    hasher = hashlib.sha256()
+    spool_path = os.path.join(
+        OUTPUT_DIR, f'.upload-{os.getpid()}-{threading.get_ident()}'
+    )
+    try:
+        with open(spool_path, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(1 << 20), b''):
+                out.write(chunk)
+                hasher.update(chunk)
+    except Exception:
+        # Client disconnects mid-upload would otherwise orphan the
+        # spool file forever (eviction only considers job dirs).
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+        raise
+
+    job_id = hasher.hexdigest()
     job_dir = os.path.join(OUTPUT_DIR, job_id)
-    os.makedirs(job_dir, exist_ok=True)
+    if all(
+        os.path.isfile(os.path.join(job_dir, f'{name}.mp3'))
+        for name in STEM_NAMES
+    ):
+        os.remove(spool_path)
+        os.utime(job_dir)  # mark recently used for eviction
+        return jsonify({'stems': _stem_urls(job_id)})
+
+    with _inflight_lock:
+        future = _inflight.get(job_id)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            _inflight[job_id] = future
+
+    if not is_owner:
+        # Another request is already separating this exact file; wait
+        # for its result rather than re-running the model and racing
+        # its cleanup over the shared job dir.
+        os.remove(spool_path)
+        try:
+            future.result()
+            return jsonify({'stems': _stem_urls(job_id)})
+        except subprocess.CalledProcessError as e:
+            return jsonify({
+                'error': 'Stem separation failed',
+                'detail': e.stderr or str(e),
+            }), 500
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
 
-    # Save uploaded file
+    os.makedirs(job_dir, exist_ok=True)
     tmp_path = os.path.join(job_dir, 'input_audio')
-    file.save(tmp_path)
+    os.replace(spool_path, tmp_path)
 
     try:
-        # ── 1. Run Demucs htdemucs_6s ──────────────────────────
-        demucs_out = os.path.join(job_dir, 'demucs_out')
-        subprocess.run([
-            'python', '-m', 'demucs',
-            '--mp3', '--mp3-bitrate', '192',
-            '-n', 'htdemucs_6s',
-            '-o', demucs_out,
-            tmp_path,
-        ], check=True, capture_output=True, text=True)
-
-        # Find the output directory (demucs names it after the model/track)
-        model_dir = os.path.join(demucs_out, 'htdemucs_6s')
-        track_dirs = os.listdir(model_dir)
-        if not track_dirs:
-            return jsonify({'error': 'Demucs produced no output'}), 500
-        stem_dir = os.path.join(model_dir, track_dirs[0])
-
-        # ── 2. Kick isolation via DSP (low-pass on drums stem) ─
-        from pydub import AudioSegment
-        drums_path = os.path.join(stem_dir, 'drums.mp3')
-        drums = AudioSegment.from_mp3(drums_path)
-
-        # Export drums to wav for filtering
-        drums_wav = os.path.join(job_dir, 'drums.wav')
-        drums.export(drums_wav, format='wav')
-
-        # Low-pass at 150Hz for kick
-        kick_path = os.path.join(job_dir, 'kick.mp3')
-        subprocess.run([
-            'ffmpeg', '-y', '-i', drums_wav,
-            '-af', 'lowpass=f=150',
-            '-b:a', '192k', kick_path,
-        ], check=True, capture_output=True)
-
-        # High-pass at 150Hz for remaining drums
-        drums_no_kick_path = os.path.join(job_dir, 'drums.mp3')
-        subprocess.run([
-            'ffmpeg', '-y', '-i', drums_wav,
-            '-af', 'highpass=f=150',
-            '-b:a', '192k', drums_no_kick_path,
-        ], check=True, capture_output=True)
-
-        # ── 3. Merge guitar + piano + other → single "other" ──
-        guitar_path = os.path.join(stem_dir, 'guitar.mp3')
-        piano_path = os.path.join(stem_dir, 'piano.mp3')
-        other_orig_path = os.path.join(stem_dir, 'other.mp3')
-
-        # Collect available stems for merging
-        merge_inputs = []
-        for p in [guitar_path, piano_path, other_orig_path]:
-            if os.path.exists(p):
-                merge_inputs.append(p)
-
-        other_path = os.path.join(job_dir, 'other.mp3')
-        if len(merge_inputs) > 1:
-            filter_args = ''.join(
-                f'[{i}:a]' for i in range(len(merge_inputs))
-            ) + f'amix=inputs={len(merge_inputs)}:duration=longest'
-            cmd = ['ffmpeg', '-y']
-            for p in merge_inputs:
-                cmd += ['-i', p]
-            cmd += ['-filter_complex', filter_args, '-b:a', '192k', other_path]
-            subprocess.run(cmd, check=True, capture_output=True)
-        elif merge_inputs:
-            shutil.copy2(merge_inputs[0], other_path)
-
-        # ── 4. Copy bass and vocals ────────────────────────────
-        bass_path = os.path.join(job_dir, 'bass.mp3')
-        vocals_path = os.path.join(job_dir, 'vocals.mp3')
-        shutil.copy2(os.path.join(stem_dir, 'bass.mp3'), bass_path)
-        shutil.copy2(os.path.join(stem_dir, 'vocals.mp3'), vocals_path)
-
-        # ── 5. Clean up large demucs output ────────────────────
-        shutil.rmtree(demucs_out, ignore_errors=True)
+        # ── 1. Separate, merge and split in a pool worker ──────
+        stem_dir = _get_demucs_pool().submit(
+            _run_job, job_dir, tmp_path,
+        ).result()
+
+        # ── 2. Encode the 5 stems to MP3 ───────────────────────
+        encode_jobs = [
+            [
+                'ffmpeg', '-y', '-i', os.path.join(stem_dir, f'{name}.wav'),
+                '-b:a', '192k', os.path.join(job_dir, f'{name}.mp3'),
+            ]
+            for name in STEM_NAMES
+        ]
+        _run_encodes(encode_jobs)
+
+        # ── 3. Clean up large intermediate WAVs ────────────────
+        shutil.rmtree(stem_dir, ignore_errors=True)
         os.remove(tmp_path)
-        if os.path.exists(drums_wav):
-            os.remove(drums_wav)
 
-        # ── 6. Return stem URLs ────────────────────────────────
-        base = f'/server/output/{job_id}'
-        return jsonify({
-            'stems': {
-                'kick': f'{base}/kick.mp3',
-                'drums': f'{base}/drums.mp3',
-                'bass': f'{base}/bass.mp3',
-                'vocals': f'{base}/vocals.mp3',
-                'other': f'{base}/other.mp3',
-            }
-        })
+        # ── 4. Return stem URLs ────────────────────────────────
+        future.set_result(None)
+        return jsonify({'stems': _stem_urls(job_id)})
 
     except subprocess.CalledProcessError as e:
+        future.set_exception(e)
         return jsonify({
             'error': 'Stem separation failed',
             'detail': e.stderr or str(e),
         }), 500
     except Exception as e:
+        future.set_exception(e)
         return jsonify({'error': str(e)}), 500
+    finally:
+        with _inflight_lock:
+            _inflight.pop(job_id, None)
 
 
 # ── BPM detection endpoint ───────────────────────────────────
+# RhythmExtractor2013 assumes 44.1kHz input (it has no sample-rate
+# parameter); feeding it anything else skews bpm/beatOffset by the
+# rate ratio, so decode at exactly this rate.
+BPM_SAMPLE_RATE = 44100
+
+
+def _decode_upload(file):
+    """Decode an uploaded file to mono float32 PCM via an ffmpeg pipe.
+
+    The upload's bytes go straight through ffmpeg's stdin/stdout, so
+    nothing touches disk and no decoder subprocess re-reads a temp file.
+    """
+    proc = subprocess.Popen([
+        'ffmpeg', '-v', 'quiet', '-i', 'pipe:0',
+        '-f', 'f32le', '-ar', str(BPM_SAMPLE_RATE), '-ac', '1', 'pipe:1',
+    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    raw, _ = proc.communicate(file.read())
+    return np.frombuffer(raw, dtype=np.float32)
+
+
 @app.route('/api/detect-bpm', methods=['POST'])
 def detect_bpm():
-    tmp_path = None
     try:
         if 'file' in request.files:
-            file = request.files['file']
-            tmp_path = os.path.join(tempfile.gettempdir(), f'bpm_{uuid.uuid4()}')
-            file.save(tmp_path)
-            audio_path = tmp_path
+            audio = _decode_upload(request.files['file'])
         elif 'path' in request.form:
             audio_path = os.path.join(PROJECT_ROOT, request.form['path'])
+            audio = MonoLoader(
+                filename=audio_path, sampleRate=BPM_SAMPLE_RATE,
+            )()
         else:
             return jsonify({'error': 'No file or path provided'}), 400
 
-        audio = MonoLoader(filename=audio_path)()
-        rhythm_extractor = RhythmExtractor2013()
+        rhythm_extractor = RhythmExtractor2013(method='multifeature')
         result = rhythm_extractor(audio)
         bpm = round(float(result[0]))
         ticks = result[1]
@@ -183,10 +419,15 @@ def detect_bpm():
         return jsonify({'bpm': bpm, 'beatOffset': beat_offset})
     except Exception as e:
         return jsonify({'error': str(e), 'bpm': 0, 'beatOffset': 0}), 200
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    # The debug reloader re-executes this script in a child process;
+    # only that child serves requests, so warming in the watcher
+    # parent would load a second, idle copy of the model.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        _warm_pool()
+        _start_eviction_thread()
+    # threaded so uploads and BPM requests overlap an in-flight
+    # separation instead of queueing behind it.
+    app.run(host='0.0.0.0', port=5001, debug=True, threaded=True)
@@ -1,23 +1,10 @@
-"""Tests for the /api/detect-bpm endpoint."""
-
-import sys
-import types
-from unittest.mock import MagicMock
-
-# Stub out audioop/pyaudioop and pydub before importing app,
-# since pydub requires audioop which was removed in Python 3.13.
-for mod_name in ('audioop', 'pyaudioop'):
-    if mod_name not in sys.modules:
-        sys.modules[mod_name] = types.ModuleType(mod_name)
-
-pydub_mock = types.ModuleType('pydub')
-pydub_mock.AudioSegment = MagicMock()
-sys.modules.setdefault('pydub', pydub_mock)
-sys.modules.setdefault('pydub.audio_segment', pydub_mock)
-sys.modules.setdefault('pydub.utils', types.ModuleType('pydub.utils'))
+"""Tests for the Flask backend: BPM detection, upload limits, stem
+serving, and output-directory eviction."""
 
 import io
-from unittest.mock import patch
+import os
+import shutil
+from unittest.mock import MagicMock, patch
 
 import numpy as np
 import pytest
@@ -32,11 +19,18 @@ def client():
         yield c
 
 
+def _mock_pipe_decode(mock_popen, samples=44100):
+    """Make the mocked ffmpeg pipe yield silent float32 PCM."""
+    mock_popen.return_value.communicate.return_value = (
+        np.zeros(samples, dtype=np.float32).tobytes(), None,
+    )
+
+
 @patch('app.RhythmExtractor2013')
-@patch('app.MonoLoader')
-def test_detect_bpm_returns_bpm_and_offset(mock_loader, mock_rhythm, client):
+@patch('app.subprocess.Popen')
+def test_detect_bpm_returns_bpm_and_offset(mock_popen, mock_rhythm, client):
     """Normal response returns bpm and beatOffset."""
-    mock_loader.return_value = MagicMock(return_value=np.zeros(44100))
+    _mock_pipe_decode(mock_popen)
     ticks = np.array([0.4, 0.8, 1.2, 1.6])
     mock_rhythm.return_value = MagicMock(return_value=(140.0, ticks, None, None, None))
 
@@ -50,10 +44,10 @@ def test_detect_bpm_returns_bpm_and_offset(mock_loader, mock_rhythm, client):
 
 
 @patch('app.RhythmExtractor2013')
-@patch('app.MonoLoader')
-def test_detect_bpm_empty_ticks(mock_loader, mock_rhythm, client):
+@patch('app.subprocess.Popen')
+def test_detect_bpm_empty_ticks(mock_popen, mock_rhythm, client):
     """Empty ticks array returns beatOffset of 0."""
-    mock_loader.return_value = MagicMock(return_value=np.zeros(44100))
+    _mock_pipe_decode(mock_popen)
     ticks = np.array([])
     mock_rhythm.return_value = MagicMock(return_value=(120.0, ticks, None, None, None))
 
@@ -67,10 +61,11 @@ def test_detect_bpm_empty_ticks(mock_loader, mock_rhythm, client):
 
 
 @patch('app.RhythmExtractor2013')
-@patch('app.MonoLoader')
-def test_detect_bpm_error_returns_defaults(mock_loader, mock_rhythm, client):
+@patch('app.subprocess.Popen')
+def test_detect_bpm_error_returns_defaults(mock_popen, mock_rhythm, client):
     """When essentia raises, bpm and beatOffset default to 0."""
-    mock_loader.return_value = MagicMock(side_effect=RuntimeError('bad audio'))
+    _mock_pipe_decode(mock_popen)
+    mock_rhythm.return_value = MagicMock(side_effect=RuntimeError('bad audio'))
 
     data = io.BytesIO(b'\x00' * 1000)
     resp = client.post('/api/detect-bpm', data={'file': (data, 'test.wav')})
@@ -104,3 +99,53 @@ def test_detect_bpm_with_path(mock_loader, mock_rhythm, client):
     assert resp.status_code == 200
     assert json_data['bpm'] == 128
     assert json_data['beatOffset'] == 0.25
+
+
+def test_separate_rejects_oversized_upload(client):
+    """Uploads beyond MAX_CONTENT_LENGTH get a JSON 413."""
+    original = app.config['MAX_CONTENT_LENGTH']
+    app.config['MAX_CONTENT_LENGTH'] = 1024
+    try:
+        data = io.BytesIO(b'\x00' * 4096)
+        resp = client.post('/api/separate', data={'file': (data, 'big.wav')})
+    finally:
+        app.config['MAX_CONTENT_LENGTH'] = original
+
+    assert resp.status_code == 413
+    assert resp.get_json()['error'] == 'File too large'
+
+
+def test_stem_download_sets_immutable_cache_headers(client):
+    """Stem downloads are served cacheable-forever with an ETag."""
+    import app as app_module
+    job_dir = os.path.join(app_module.OUTPUT_DIR, 'testjob')
+    os.makedirs(job_dir, exist_ok=True)
+    with open(os.path.join(job_dir, 'kick.mp3'), 'wb') as f:
+        f.write(b'mp3-bytes')
+    try:
+        resp = client.get('/server/output/testjob/kick.mp3')
+
+        assert resp.status_code == 200
+        assert 'immutable' in resp.headers['Cache-Control']
+        assert resp.headers.get('ETag')
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def test_evict_old_jobs_trims_oldest_to_budget(tmp_path, monkeypatch):
+    """Eviction removes least recently used jobs until under budget."""
+    import app as app_module
+
+    for i, name in enumerate(['old', 'mid', 'new']):
+        job_dir = tmp_path / name
+        job_dir.mkdir()
+        (job_dir / 'kick.mp3').write_bytes(b'\x00' * 100)
+        os.utime(job_dir, (1000 + i, 1000 + i))
+
+    monkeypatch.setattr(app_module, 'OUTPUT_DIR', str(tmp_path))
+    monkeypatch.setattr(app_module, 'OUTPUT_BUDGET_BYTES', 250)
+    app_module._evict_old_jobs()
+
+    assert not (tmp_path / 'old').exists()
+    assert (tmp_path / 'mid').exists()
+    assert (tmp_path / 'new').exists()